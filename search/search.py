@@ -19,17 +19,18 @@
 import logging
 import json
 import pickle
-import copy
-import pandas
-import socket
+import pyarrow
+import pyarrow.compute
 import time
+import itertools
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta, timezone
-from random import randint
 
 import knime.extension as knext
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.oauth2.credentials import Credentials
+
+# The Google API client libraries are imported in the methods using them. KNIME imports this module
+# when loading the extension and when opening node dialogs, which do not need them.
 
 
 OAUTH_CLIENT_CONFIG = {
@@ -49,6 +50,18 @@ KNIME_NODE_KEYWORDS = [
     "GSC"
 ]
 
+# How often a request is retried after a rate limit (HTTP 429, or 403 with a rate limit reason) or
+# server error response. googleapiclient waits a random time of up to 2^n seconds before retry n.
+API_NUM_RETRIES = 5
+
+# The API responds with camel case permission levels, while its discovery document lists the
+# enum names. Both spellings are accepted to not show unverified properties either way.
+UNVERIFIED_PERMISSION_LEVELS = frozenset(["siteUnverifiedUser", "SITE_UNVERIFIED_USER"])
+
+# Version 1 of the auth port object storage was the pickled credentials JSON string. Version 2
+# stores the UTF-8 encoded credentials JSON string after a single version byte.
+AUTH_PORT_OBJECT_VERSION = 2
+
 
 logger = logging.getLogger(__name__)
 
@@ -67,7 +80,7 @@ class SearchAuthPortSpec(knext.PortObjectSpec):
 
     @classmethod
     def deserialize(cls, data: dict) -> "SearchAuthPortSpec":
-        cls(data["spec"])
+        return cls(data["spec"])
 
 
     def get_spec(self):
@@ -81,11 +94,16 @@ class SearchAuthPortObject(knext.PortObject):
 
 
     def serialize(self) -> bytes:
-        return pickle.dumps(self._credentials)
+        return bytes([AUTH_PORT_OBJECT_VERSION]) + self._credentials.encode("utf-8")
 
 
     @classmethod
     def deserialize(cls, spec: SearchAuthPortSpec, storage: bytes) -> "SearchAuthPortSpec":
+        if storage[0] == AUTH_PORT_OBJECT_VERSION:
+            return cls(spec, storage[1:].decode("utf-8"))
+
+        # Workflows saved before version 2 contain the pickled credentials. A pickle never
+        # starts with the version byte, it starts with the PROTO opcode or an ASCII opcode.
         return cls(spec, pickle.loads(storage))
 
 
@@ -125,45 +143,23 @@ class SearchAuthenticator:
         return SearchAuthPortSpec()
     
 
-    def get_free_port(self):
-        for i in range(0, 100):
-            port = randint(10000, 30000)
-            if self.is_port_free(port=port) == True:
-                return port
-        
-        raise RuntimeError("Can not find free port on loopback interface.")
-
-
-    def is_port_free(self, port):
-        with socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM) as s:
-            try:
-                s.bind(("127.0.0.1", port))
-                return True
-            except OSError:
-                return False
-
-
     def set_available_props(self, exec_context, credentials):
-        service = build(
-            serviceName="searchconsole",
-            version="v1",
-            credentials=credentials
-        )
-        
-        site_entries = service.sites().list().execute()["siteEntry"]
+        from googleapiclient.discovery import build
 
-        service.close()
+        with build(serviceName="searchconsole", version="v1", credentials=credentials) as service:
+            # The siteEntry key is omitted when the account has no properties at all.
+            site_entries = service.sites().list().execute(num_retries=API_NUM_RETRIES).get("siteEntry", [])
 
-        available_props = []
-        for e in site_entries:
-            if "unverified" in e["permissionLevel"].lower():
-                continue
-            available_props.append(e["siteUrl"])
+        available_props = [
+            e["siteUrl"] for e in site_entries if e["permissionLevel"] not in UNVERIFIED_PERMISSION_LEVELS
+        ]
 
         exec_context.flow_variables["available_props"] = available_props
 
 
     def execute(self, exec_context):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         flow = InstalledAppFlow.from_client_config(
             client_config=OAUTH_CLIENT_CONFIG,
             scopes=GOOGLE_API_SCOPES
@@ -171,7 +167,9 @@ class SearchAuthenticator:
 
         credentials = flow.run_local_server(
             host="127.0.0.1",
-            port=self.get_free_port(),
+            # Port 0 lets the OS assign a free port when the local server binds.
+            # The redirect URI is built from the port the server actually got.
+            port=0,
             authorization_prompt_message=None,
             success_message="Authorized successfully.\n\nRevoke access of this application to your Google Account anytime at https://myaccount.google.com/connections\n\nHeads up! Your authentication details are saved in your workflow. If you share a workflow with an executed Authenticator node, anyone who has access to the workflow can use it to run queries on your Google Search Console properties.\n\nYou can close this window now.",
             open_browser=True,
@@ -190,6 +188,28 @@ class SearchAuthenticator:
         )
 
 
+# The dialog asks for the schema every time it is opened, while the available properties only
+# change when the Authenticator node is executed again. The schema is therefore built once per
+# tuple of properties.
+@functools.lru_cache(maxsize=8)
+def get_property_schema(props):
+    columns = []
+    for prop in props:
+        # According to the function signature of knext.Column(), the metadata parameter is optional.
+        # However, when setting it to None or an empty dict, an error gets written to the log file
+        # which states the keys preferred_value_type and displayed_column_type are missing.
+        # Therefore these keys are specified with empty values.
+        columns.append(
+            knext.Column(
+                ktype=knext.string(),
+                name=prop,
+                metadata={"preferred_value_type" : "", "displayed_column_type": ""}
+            )
+        )
+    
+    return knext.Schema.from_columns(columns=columns)
+
+
 @knext.parameter_group(label="Property and Type")
 class PropertyTypeParameterGroup:
     def getPropertySchema(dialog_creation_context):
@@ -197,21 +217,7 @@ class PropertyTypeParameterGroup:
         if "available_props" in dialog_creation_context.flow_variables:
             availableProps = dialog_creation_context.flow_variables.get("available_props")
 
-        columns = []
-        for prop in availableProps:
-            # According to the function signature of knext.Column(), the metadata parameter is optional.
-            # However, when setting it to None or an empty dict, an error gets written to the log file
-            # which states the keys preferred_value_type and displayed_column_type are missing.
-            # Therefore these keys are specified with empty values.
-            columns.append(
-                knext.Column(
-                    ktype=knext.string(),
-                    name=prop,
-                    metadata={"preferred_value_type" : "", "displayed_column_type": ""}
-                )
-            )
-        
-        return knext.Schema.from_columns(columns=columns)
+        return get_property_schema(tuple(availableProps))
 
     property = knext.ColumnParameter(
         label="Property",
@@ -279,6 +285,16 @@ class DateRangeParameterGroup:
     )
 
 
+# Number of days covered by each of the fixed interval options.
+INTERVAL_DAYS = {
+    DateRangeParameterGroup.IntervalOptions.d7.name: 7,
+    DateRangeParameterGroup.IntervalOptions.d28.name: 28,
+    DateRangeParameterGroup.IntervalOptions.d90.name: 90,
+    DateRangeParameterGroup.IntervalOptions.d180.name: 180,
+    DateRangeParameterGroup.IntervalOptions.d365.name: 365
+}
+
+
 @knext.parameter_group(label="Group By Dimension")
 class DimensionParameterGroup:
     date = knext.BoolParameter(label="Date", description="Break down the results by date.", default_value=False)
@@ -289,6 +305,18 @@ class DimensionParameterGroup:
     search_appearance = knext.BoolParameter(label="Search Appearance", description="Break down the results by search appearance.", default_value=False)
 
 
+# Metrics returned for every row of a Search Analytics query, in the order of the API response.
+METRIC_FIELDS = [
+    pyarrow.field("clicks", pyarrow.int64()),
+    pyarrow.field("impressions", pyarrow.int64()),
+    pyarrow.field("ctr", pyarrow.float64()),
+    pyarrow.field("position", pyarrow.float64())
+]
+
+# API names of the dimensions, in the order of the DimensionParameterGroup parameters.
+DIMENSIONS = ("date", "country", "device", "page", "query", "searchAppearance")
+
+
 @knext.parameter_group(label="Advanced", is_advanced=True)
 class AdvancedParameterGroup:
     class DataStateOptions(knext.EnumParameterOptions):
@@ -350,48 +378,33 @@ class SearchQuery:
         today = datetime.now(tz=timezone.utc).date()
         end_date = today - timedelta(days=3)
 
-        date_delta = 365 - 1
-        match (self.date_range.interval):
-            case DateRangeParameterGroup.IntervalOptions.d7.name:
-                date_delta = 7 - 1
-            case DateRangeParameterGroup.IntervalOptions.d28.name:
-                date_delta = 28 - 1
-            case DateRangeParameterGroup.IntervalOptions.d90.name:
-                date_delta = 90 - 1
-            case DateRangeParameterGroup.IntervalOptions.d180.name:
-                date_delta = 180 - 1
+        # The end date is part of the interval, hence one day less is subtracted.
+        date_delta = INTERVAL_DAYS.get(self.date_range.interval, 365) - 1
         start_date = end_date - timedelta(days=date_delta)
         return start_date, end_date
     
 
     def get_selected_dimensions(self):
-        selected = []
-
-        if self.dimension.date:
-            selected.append("date")
-        if self.dimension.country:
-            selected.append("country")
-        if self.dimension.device:
-            selected.append("device")
-        if self.dimension.page:
-            selected.append("page")
-        if self.dimension.query:
-            selected.append("query")
-        if self.dimension.search_appearance:
-            selected.append("searchAppearance")
+        # The flags have to be in the same order as the names in DIMENSIONS.
+        flags = (
+            self.dimension.date,
+            self.dimension.country,
+            self.dimension.device,
+            self.dimension.page,
+            self.dimension.query,
+            self.dimension.search_appearance
+        )
 
-        return selected
+        return list(itertools.compress(DIMENSIONS, flags))
 
 
-    def get_request_body(self, row_limit, start_row):
+    def get_request_body(self, dimensions, start_date, end_date, row_limit, start_row):
         body = {}
 
-        start_date, end_date = self.get_date_range()
-
         body["type"] = self.property_type.type
         body["startDate"] = start_date.isoformat()
         body["endDate"] = end_date.isoformat()
-        body["dimensions"] = self.get_selected_dimensions()
+        body["dimensions"] = dimensions
         body["rowLimit"] = row_limit
         body["startRow"] = start_row
         body["dataState"] = self.advanced.data_state
@@ -400,35 +413,36 @@ class SearchQuery:
         return body
 
 
-    def parse_response(self, api_response):
-        dimensions = self.get_selected_dimensions()
-        new_rows = []
+    def get_result_schema(self, dimensions):
+        fields = [pyarrow.field(dim, pyarrow.string()) for dim in dimensions]
+        return pyarrow.schema(fields + METRIC_FIELDS)
 
-        if "rows" not in api_response:
-            return new_rows
 
-        for row in api_response["rows"]:
-            new_row = {}
+    def parse_response(self, api_response, dimensions):
+        # Rows without dimensions come without the keys field, which pyarrow fills with null.
+        response_schema = pyarrow.schema([pyarrow.field("keys", pyarrow.list_(pyarrow.string()))] + METRIC_FIELDS)
+        page = pyarrow.Table.from_pylist(mapping=api_response.get("rows", []), schema=response_schema)
 
-            for i, dim in enumerate(dimensions):
-                new_row[dim] = row["keys"][i]
+        # Each row holds the values of the selected dimensions in its keys list, in the
+        # order they were requested. Split them into one column per dimension and put
+        # these columns in front of the metrics.
+        keys = page.column("keys")
+        dimension_columns = [pyarrow.compute.list_element(keys, i) for i in range(len(dimensions))]
 
-            new_row.update(copy.deepcopy(row))
-            if "keys" in new_row:
-                del new_row["keys"]
-            
-            new_rows.append(new_row)
-
-        return new_rows
+        return pyarrow.Table.from_arrays(
+            arrays=dimension_columns + page.columns[1:],
+            schema=self.get_result_schema(dimensions)
+        )
     
     def create_credentials(self, credentials_json):
+        from google.oauth2.credentials import Credentials
+
         info = json.loads(credentials_json)
 
         if "refresh_token" not in info:
             # Make sure the credentials have not expired.
             time_expiry = datetime.fromisoformat(info["expiry"])
-            time_now = datetime.now(tz=timezone.utc)
-            if (time_expiry.timestamp() - time_now.timestamp()) <= 0:
+            if time_expiry.timestamp() <= time.time():
                 raise PermissionError("Authentication expired. Please rerun the authenticator node.")
             
             # Credentials.from_authorized_user_info raises an error when the refresh_token key
@@ -437,16 +451,25 @@ class SearchQuery:
 
         return Credentials.from_authorized_user_info(info=info)
     
-    def get_api_request_delay(self, i):
-        max_delay = 1
-        weight = 0.1
+    def query_page(self, service, body, credentials=None):
+        from googleapiclient.http import build_http
+        from google_auth_httplib2 import AuthorizedHttp
 
-        delay = i * weight
+        request = service.searchanalytics().query(
+            siteUrl=self.property_type.property,
+            body=body
+        )
 
-        if max_delay < delay:
-            delay = max_delay
+        if credentials is None:
+            return request.execute(num_retries=API_NUM_RETRIES)
 
-        return delay
+        # httplib2.Http is not thread-safe. Requests running concurrently to others therefore
+        # get their own authorized connection instead of the one of the service.
+        http = AuthorizedHttp(credentials=credentials, http=build_http())
+        try:
+            return request.execute(http=http, num_retries=API_NUM_RETRIES)
+        finally:
+            http.close()
 
 
     def configure(self, config_context, auth_port_spec):
@@ -454,45 +477,75 @@ class SearchQuery:
 
 
     def execute(self, exec_context, auth_port_object):
-        if self.property_type.property == None:
+        from googleapiclient.discovery import build
+
+        if self.property_type.property is None:
             raise ValueError("No property selected!")
         
-        service = build(
-            serviceName="searchconsole",
-            version="v1",
-            credentials=self.create_credentials(auth_port_object.get_credentials())
-        )
-
+        credentials = self.create_credentials(auth_port_object.get_credentials())
         api_row_limit = 25000
-        rows = []
-
-        i = 0
-        while True:
-            start_row = i * api_row_limit
-
-            exec_context.set_progress(start_row / self.advanced.row_limit)
-
-            api_response = service.searchanalytics().query(
-                siteUrl=self.property_type.property,
-                body=self.get_request_body(row_limit=api_row_limit, start_row=start_row)
-            ).execute()
-
-            new_rows = self.parse_response(api_response)
-            rows += new_rows
+        row_limit = self.advanced.row_limit
 
-            if self.advanced.row_limit != 0 and self.advanced.row_limit <= len(rows):
-                rows = rows[:self.advanced.row_limit]
-                break
-
-            if len(new_rows) < api_row_limit:
-                break
-
-            i += 1
-            time.sleep(self.get_api_request_delay(i))
-
-        service.close()
+        # These do not change between pages, so they are determined once per execution.
+        dimensions = self.get_selected_dimensions()
+        start_date, end_date = self.get_date_range()
 
-        return knext.Table.from_pandas(
-            data=pandas.DataFrame(data=rows),
+        with build(serviceName="searchconsole", version="v1", credentials=credentials) as service:
+            # Only a full first page means that there are more rows to fetch.
+            first_page = self.parse_response(
+                api_response=self.query_page(
+                    service=service,
+                    body=self.get_request_body(
+                        dimensions=dimensions,
+                        start_date=start_date,
+                        end_date=end_date,
+                        row_limit=min(api_row_limit, row_limit),
+                        start_row=0
+                    )
+                ),
+                dimensions=dimensions
+            )
+            pages = [first_page]
+            row_count = len(first_page)
+
+            exec_context.set_progress(row_count / row_limit)
+
+            if len(first_page) == api_row_limit and api_row_limit < row_limit:
+                # Fetch the remaining pages concurrently.
+                start_rows = range(api_row_limit, row_limit, api_row_limit)
+                with ThreadPoolExecutor(max_workers=len(start_rows)) as executor:
+                    futures = []
+                    for start_row in start_rows:
+                        futures.append(
+                            executor.submit(
+                                self.query_page,
+                                service=service,
+                                body=self.get_request_body(
+                                    dimensions=dimensions,
+                                    start_date=start_date,
+                                    end_date=end_date,
+                                    # Only request as many rows as are still missing to reach the row
+                                    # limit, so the last page does not have to be trimmed afterwards.
+                                    row_limit=min(api_row_limit, row_limit - start_row),
+                                    start_row=start_row
+                                ),
+                                credentials=credentials
+                            )
+                        )
+
+                    for future in futures:
+                        page = self.parse_response(api_response=future.result(), dimensions=dimensions)
+                        pages.append(page)
+                        row_count += len(page)
+
+                        exec_context.set_progress(row_count / row_limit)
+
+                        # Pages after a short page are beyond the end of the results.
+                        if len(page) < api_row_limit:
+                            break
+
+        # All pages share the result schema, so they can be concatenated without copying.
+        return knext.Table.from_pyarrow(
+            data=pyarrow.concat_tables(pages),
             row_ids="auto"
         )
\ No newline at end of file